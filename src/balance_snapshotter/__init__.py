@@ -1,21 +1,67 @@
 """BalanceSnappshotter - module for eth-brownie used to take snapshots of token balances of accounts."""
+from __future__ import annotations
+
 import asyncio
-from tabulate import tabulate
-from typing import Union
+import logging
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+from typing import TYPE_CHECKING, Union, Optional, Iterable, Iterator, Coroutine, Any, Callable
 from rich.console import Console
+from rich.markup import escape
+from rich.table import Table, Column
 from .token_data import get_token_data
-from brownie.network.contract import Contract
-from brownie.network.account import Account
-from brownie import (
-    interface,
-    accounts as b_accounts
-)
+
+# brownie and aiohttp are only imported when they're first needed, as importing brownie takes a long time and
+# the formatting helpers don't need it
+if TYPE_CHECKING:
+    import aiohttp
+    from brownie.network.contract import Contract
+    from brownie.network.account import Account
 
 __version__ = "0.3.0"
 
 console = Console()
+logger = logging.getLogger(__name__)
 token_data = get_token_data()
 
+# maximum amount of balances kept in the balance cache of a snapshotter
+BALANCE_CACHE_SIZE = 10_000
+
+
+@lru_cache(maxsize=None)
+def amount_formatter(decimals: int = 18) -> Callable[[int], str]:
+    """
+    Create a function that moves the decimal point for token amounts of a token.
+
+    The power of ten of the decimals and the format spec of the fraction are bound to the function, so formatting
+    many amounts of the same token doesn't look them up again for every amount. One function is created per decimals.
+
+    Parameters
+    ----------
+    decimals: int
+        The decimals of the token.
+
+    Returns
+    -------
+    Callable[[int], str]
+        Function that returns amount of tokens divided by 10 to the power of `decimals`, with 18 fractional digits.
+        Integer arithmetic is used, so that precision isn't lost for amounts that don't fit into a float.
+    """
+    scale = 10 ** decimals
+    fraction_spec = f"0{decimals}d"
+
+    def format_amount(amount: int) -> str:
+        sign = "-" if amount < 0 else ""
+        whole, fraction = divmod(abs(amount), scale)
+        # pad the fraction to `decimals` digits, then cut or pad it to 18 digits
+        fraction = format(fraction, fraction_spec)[:18].ljust(18, "0")
+
+        return f"{sign}{whole:,}.{fraction}"
+
+    return format_amount
+
 
 def decimal_converter(amount: int = 0, decimals: int = 18) -> str:
     """
@@ -31,9 +77,143 @@ def decimal_converter(amount: int = 0, decimals: int = 18) -> str:
     Returns
     -------
     str
-        Amount of tokens divided by 10 to the power of `decimals`.
+        Amount of tokens divided by 10 to the power of `decimals`, with 18 fractional digits.
+    """
+    return amount_formatter(decimals)(amount)
+
+
+def format_table(rows: list[tuple[str, str, str]]) -> str:
+    """
+    Format balance rows into a table.
+
+    Parameters
+    ----------
+    rows: List[Tuple[str, str, str]]
+        Rows of (asset, account, balance).
+
+    Returns
+    -------
+    str
+        The table with asset and account columns aligned to the left and balance column aligned to the right.
+
+        Example:
+        asset    account                                                  balance
+        -------  ------------------------------------------  --------------------
+        WBTC     0x5b5cF8620292249669e1DCC73B753d01543D6Ac7  2.361588530000000130
+    """
+    # column widths are computed in one pass over the rows
+    asset_width, account_width, balance_width = len("asset"), len("account"), len("balance")
+    for asset, account, balance in rows:
+        if len(asset) > asset_width:
+            asset_width = len(asset)
+        if len(account) > account_width:
+            account_width = len(account)
+        if len(balance) > balance_width:
+            balance_width = len(balance)
+
+    row_format = f"{{:<{asset_width}}}  {{:<{account_width}}}  {{:>{balance_width}}}"
+    lines = [
+        row_format.format("asset", "account", "balance"),
+        row_format.format("-" * asset_width, "-" * account_width, "-" * balance_width)
+    ]
+    lines.extend(row_format.format(*row) for row in rows)
+
+    return "\n".join(lines)
+
+
+def print_table(rows: list[tuple[str, str, str]]):
+    """
+    Print balance rows.
+
+    When printing to a terminal, the rows are printed as a table. Otherwise, e.g. when the output is redirected to a
+    file, every row is printed as a tab separated line, so that no column widths have to be measured.
+
+    Parameters
+    ----------
+    rows: List[Tuple[str, str, str]]
+        Rows of (asset, account, balance).
+    """
+    if not console.is_terminal:
+        lines = ["asset\taccount\tbalance"]
+        lines.extend(f"{asset}\t{account}\t{balance}" for asset, account, balance in rows)
+        console.file.write("\n".join(lines) + "\n")
+        return
+
+    # addresses and amounts are folded onto the next line instead of being cut off when the terminal is too narrow
+    table = Table(
+        Column("asset", overflow="fold"),
+        Column("account", overflow="fold"),
+        Column("balance", justify="right", overflow="fold")
+    )
+    for asset, account, balance in rows:
+        # symbols come from the token contracts, so they're escaped in case they contain markup
+        table.add_row(escape(asset), account, balance)
+
+    console.print(table)
+
+
+def get_address(item: Union[Contract, Account, str]) -> str:
+    """
+    Get the address of a token or an account.
+
+    Parameters
+    ----------
+    item: Union[brownie.network.contract.Contract, brownie.network.account.Account, str]
+        The token, account or address.
+
+    Returns
+    -------
+    str
+        The address.
+    """
+    return item if isinstance(item, str) else item.address
+
+
+def unique_by_address(
+        items: Iterable[Union[Contract, Account, str]],
+        seen: set[str]
+) -> Iterator[Union[Contract, Account, str]]:
+    """
+    Filter out tokens or accounts whose address has already been seen.
+
+    Parameters
+    ----------
+    items: Iterable[Union[brownie.network.contract.Contract, brownie.network.account.Account, str]]
+        The tokens, accounts or addresses.
+    seen: Set[str]
+        Lowercase addresses that have already been seen, addresses of the yielded items are added to it.
+
+    Yields
+    ------
+    Union[brownie.network.contract.Contract, brownie.network.account.Account, str]
+        The items whose address hadn't been seen yet.
+    """
+    for item in items:
+        address = get_address(item).lower()
+        if address not in seen:
+            seen.add(address)
+            yield item
+
+
+def to_account(account: Union[Account, str]) -> Account:
+    """
+    Convert a raw address into an account object.
+
+    Parameters
+    ----------
+    account: Union[brownie.network.account.Account, str]
+        The account or its address.
+
+    Returns
+    -------
+    brownie.network.account.Account
+        The account object, accounts that are already account objects are returned as is.
     """
-    return "{:,.18f}".format(amount / 10 ** decimals)
+    if isinstance(account, str):
+        from brownie import accounts
+        return accounts.at(account, force=True)
+
+    return account
 
 
 class BalanceSnapshotter:
@@ -42,12 +222,21 @@ class BalanceSnapshotter:
 
     Parameters
     ----------
-    _tokens: List[Union[brownie.network.contract.Contract, str]]
-        List of tokens in either string from or badger token form.
-    _accounts: List[Union[brownie.network.account.Account, str]]
-        List of tokens in either string form or badger account form.
-    loop: Optional[asyncio.BaseEventLoop]
-        Asyncio loop that will be used in the creation of the snapshot.
+    _tokens: Iterable[Union[brownie.network.contract.Contract, str]]
+        Tokens in either string from or badger token form.
+    _accounts: Iterable[Union[brownie.network.account.Account, str]]
+        Accounts in either string form or badger account form.
+    loop: Optional[asyncio.AbstractEventLoop]
+        Asyncio loop that will be used by `snap`. If not provided, a new loop is created on the first `snap`.
+    erc20_batch_size: int
+        Maximum amount of balanceOf calls in a single JSON-RPC batch request.
+    multicall_batch_size: int
+        Maximum amount of calls in a single multicall.
+    max_concurrency: int
+        Maximum amount of balanceOf calls in flight at once when they're made separately.
+    batch_window_ms: float
+        Time in milliseconds `async_snap` waits for other concurrent `async_snap` calls, so that they can all share
+        the same balance fetch. 0 disables waiting.
 
     Attributes
     -----------
@@ -56,44 +245,112 @@ class BalanceSnapshotter:
     accounts: List[brownie.network.account.Account]
         List of accounts.
     snaps: List[dict]
-        List of snapshots which are in dict form {"name": str, balances: Balances}
-    loop: asyncio.BaseEventLoop
-        Asyncio loop used to run snapshot coroutine.
-    balance_event: asyncio.Event
-        Event used to manage the flow of the snap method.
+        List of snapshots which are in dict form {"name": str, "block": int, "balances": Balances}
+    multicall: Optional[brownie.network.contract.Contract]
+        Multicall3 or Multicall2 contract of the active chain, None if neither is deployed. Looked up on the first snap.
+    erc20_batch_size: int
+        Maximum amount of balanceOf calls in a single JSON-RPC batch request, used when no multicall contract is
+        deployed.
+    multicall_batch_size: int
+        Maximum amount of calls in a single multicall, larger snaps are split into several multicalls at the same block.
+    max_concurrency: int
+        Maximum amount of balanceOf calls in flight at once, used when they can't be batched.
+    batch_window_ms: float
+        Time in milliseconds `async_snap` waits for other concurrent `async_snap` calls to share a balance fetch with.
     """
 
-    def __init__(self, _tokens: list[Union[Contract, str]], _accounts: list[Union[Account, str]], *, loop: asyncio.BaseEventLoop = None):
+    def __init__(
+            self,
+            _tokens: Iterable[Union[Contract, str]],
+            _accounts: Iterable[Union[Account, str]],
+            *,
+            loop: asyncio.AbstractEventLoop = None,
+            erc20_batch_size: int = 100,
+            multicall_batch_size: int = 500,
+            max_concurrency: int = 20,
+            batch_window_ms: float = 0
+    ):
+        # blocking brownie calls are run in this executor, its threads are only started when first needed
+        self._executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=max_concurrency)
+
+        # addresses of the added tokens and accounts in lowercase, used to skip duplicates
+        self._token_addresses: set[str] = set()
+        self._account_addresses: set[str] = set()
+
+        from brownie import interface
+
         # convert any raw addresses to proper token objects
-        for i, token in enumerate(_tokens):
-            if type(token) == str:
-                _tokens[i] = interface.IERC20(token)
+        self.tokens: list[Contract] = [
+            interface.IERC20(token) if isinstance(token, str) else token
+            for token in unique_by_address(_tokens, self._token_addresses)
+        ]
 
-        # convert any raw addresses to proper account objects
-        for i, account in enumerate(_accounts):
-            if type(account) == str:
-                _accounts[i] = b_accounts.at(account, force=True)
+        # convert any raw addresses to proper account objects, this can require an rpc call to unlock the account,
+        # so the addresses are resolved concurrently
+        _accounts = list(unique_by_address(_accounts, self._account_addresses))
+        if any(isinstance(account, str) for account in _accounts):
+            _accounts = list(self._executor.map(to_account, _accounts))
 
-        self.tokens: list[Contract] = _tokens
         self.accounts: list[Account] = _accounts
         self.snaps: list[dict] = []
 
-        self.loop: asyncio.BaseEventLoop = loop if loop else asyncio.get_event_loop()
-        self.balance_event: asyncio.Event = asyncio.Event()
+        # token decimals and symbols keyed by token address, they're looked up once per token instead of for every
+        # row when printing. They're fetched on the first snap or by `prefetch_metadata`, so that they can be fetched
+        # for all tokens in as few multicalls as possible
+        self._decimals: dict[str, int] = {}
+        self._symbols: dict[str, str] = {}
+
+        # the loop is only created when it's first needed
+        self._loop: Optional[asyncio.AbstractEventLoop] = loop
+        # True if the loop was created by the snapshotter, in which case it's also closed by it
+        self._owns_loop: bool = False
+
+        self.multicall: Optional[Contract] = None
+        self._multicall_checked: bool = False
+        self.erc20_batch_size: int = erc20_batch_size
+        self.multicall_batch_size: int = multicall_batch_size
+        self.max_concurrency: int = max_concurrency
+        self.batch_window_ms: float = batch_window_ms
+        # balance fetch that concurrent `async_snap` calls can still join, None once it has started fetching
+        self._pending_snapshot: Optional[asyncio.Task] = None
+
+        # HTTP session for JSON-RPC batch requests, only created when it's first needed
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._session_loop: Optional[asyncio.AbstractEventLoop] = None
+        # sessions replaced while their loop was stopped, they're closed by `aclose` once it runs in their loop
+        self._stale_sessions: list[tuple[aiohttp.ClientSession, asyncio.AbstractEventLoop]] = []
+        # set to False once the provider rejects a batch request, after that eth_calls are sent separately
+        self._batch_requests_supported: bool = True
+
+        # balances keyed by (block hash, token address, account address), oldest entries are evicted first.
+        # the hash is used instead of the block number, as development chains can return to the same block number
+        # with different state, e.g. after chain.revert(). only used when no multicall contract is deployed
+        self._balance_cache: OrderedDict[tuple[bytes, str, str], int] = OrderedDict()
+
+        # row and column indices shared by the balances of all snaps, rebuilt when tokens or accounts are added
+        self._token_index: dict[str, int] = {}
+        self._account_index: dict[str, int] = {}
 
     def add_token(self, token: Union[Contract, str]):
         """
         Add a token to the list of tokens.
 
         If a token is provided as a string, it will be converted to brownie.network.contract.Contract.
+        Tokens that have already been added are ignored.
 
         Parameters
         -----------
         token: Union[brownie.network.contract.Contract, str]
             The token that will be added
         """
+        address = get_address(token).lower()
+        if address in self._token_addresses:
+            return
+        self._token_addresses.add(address)
+
         # if provided token is in string format, change it to Token object
-        if type(token) == str:
+        if isinstance(token, str):
+            from brownie import interface
             token = interface.IERC20(token)
         self.tokens.append(token)
 
@@ -102,22 +359,101 @@ class BalanceSnapshotter:
         Add an account to the list of accounts.
 
         If account is provided as a string, it will be converted to an account.
+        Accounts that have already been added are ignored.
 
         Parameters
         -----------
         account: Union[brownie.network.account.Account, str]
             The account that will be added.
         """
+        address = get_address(account).lower()
+        if address in self._account_addresses:
+            return
+        self._account_addresses.add(address)
+
         # Convert raw addresses into account objects
-        if type(account) == str:
-            account = b_accounts.at(account, force=True)
-        self.accounts.append(account)
+        self.accounts.append(to_account(account))
+
+    def prefetch_metadata(self):
+        """
+        Fetch the names, symbols and decimals of all the tokens that haven't been fetched yet.
+
+        If Multicall3 or Multicall2 is deployed on the active chain, the data of all the uncached tokens is fetched in
+        multicalls of at most `multicall_batch_size` calls, otherwise it's fetched for every token separately.
+        Called automatically by the first snap after tokens have been added.
+        """
+        from .multicall import aggregate_token_data
+
+        uncached = [token for token in self.tokens if not token_data.is_cached(token)]
+        multicall = self._resolve_multicall()
+        if uncached and multicall is not None:
+            for token, data in zip(uncached, aggregate_token_data(multicall, uncached, self.multicall_batch_size)):
+                # tokens whose data couldn't be decoded are fetched separately by `_add_token_data`
+                if data is not None:
+                    token_data.set_token_data(token, data)
+
+        for token in self.tokens:
+            if token.address not in self._decimals:
+                self._add_token_data(token)
+
+    def _resolve_multicall(self) -> Optional[Contract]:
+        """
+        Get the multicall contract of the active chain, it's only looked up once, as it requires an extra rpc call.
+
+        Returns
+        -------
+        Optional[brownie.network.contract.Contract]
+            The Multicall3 or Multicall2 contract or None if neither is deployed on the active chain.
+        """
+        if not self._multicall_checked:
+            from .multicall import get_multicall
+            self.multicall = get_multicall()
+            self._multicall_checked = True
+
+        return self.multicall
+
+    def _get_indices(self) -> tuple[dict[str, int], dict[str, int]]:
+        """
+        Get the row index of every token and the column index of every account.
+
+        The same dicts are reused for every snap until tokens or accounts are added, so that snaps taken with the same
+        tokens and accounts can be compared without lining them up first. Tokens and accounts are only ever appended,
+        so a change in length means that the indices are out of date.
+
+        Returns
+        -------
+        Tuple[Dict[str, int], Dict[str, int]]
+            Row indices keyed by token address and column indices keyed by account address.
+        """
+        # new dicts are created instead of updating the old ones, as older snaps still use them
+        if len(self._token_index) != len(self.tokens):
+            self._token_index = {token.address: i for i, token in enumerate(self.tokens)}
+        if len(self._account_index) != len(self.accounts):
+            self._account_index = {account.address: i for i, account in enumerate(self.accounts)}
+
+        return self._token_index, self._account_index
+
+    def _add_token_data(self, token: Contract):
+        """
+        Add the decimals and symbol of a token to the token data of the snapshotter.
+
+        Both are taken from a single token data lookup, which is only fetched from chain if it isn't cached yet.
+
+        Parameters
+        -----------
+        token: brownie.network.contract.Contract
+            The token.
+        """
+        data = token_data.fetch_token_data(token)
+        self._decimals[token.address] = data['decimals']
+        self._symbols[token.address] = data['symbol']
 
     def snap(self, name: str = "", print_snap: bool = False) -> dict[str, Union[str, 'Balances']]:
         """
         Take a snap of the current state of all the tokens of all the accounts.
 
         Optionally print out the snap in a table form.
+        Can't be used while a loop is running in the current thread, use `async_snap` instead.
 
         Parameters
         -----------
@@ -129,20 +465,33 @@ class BalanceSnapshotter:
         Returns
         -------
         Dict[str, Union[str, Balances]]
-            The snap that was taken. {"name": name, "balances": Balances}
+            The snap that was taken. {"name": name, "block": block number, "balances": Balances}
         """
-        # create a task if the loop is already running, otherwise run the loop until the async function completes.
-        if self.loop.is_running():
-            self.loop.create_task(self._async_take_snapshot(name))
-        else:
-            self.loop.run_until_complete(self._async_take_snapshot(name))
+        return self._run(self.async_snap(name, print_snap), "async_snap")
 
-        while not self.balance_event.is_set():
-            pass
+    async def async_snap(self, name: str = "", print_snap: bool = False) -> dict[str, Union[str, 'Balances']]:
+        """
+        Take a snap of the current state of all the tokens of all the accounts from async context.
+
+        Optionally print out the snap in a table form.
+
+        Parameters
+        -----------
+        name: str
+            The name that will be assigned to the snap.
+        print_snap: bool
+            If True, snap will be printed out.
 
-        self.balance_event.clear()
-        snap = self.snaps[-1]
-        balances = snap['balances']
+        Returns
+        -------
+        Dict[str, Union[str, Balances]]
+            The snap that was taken. {"name": name, "block": block number, "balances": Balances}
+        """
+        if self.batch_window_ms > 0:
+            snap = await self._coalesced_snapshot(name)
+        else:
+            snap = await self._async_take_snapshot(name)
+        self.snaps.append(snap)
 
         if print_snap:
             if name != "":
@@ -151,38 +500,303 @@ class BalanceSnapshotter:
                         name,
                     )
                 )
-            balances.print()
+            snap['balances'].print()
 
         return snap
 
-    async def _async_take_snapshot(self, name: str):
+    async def _coalesced_snapshot(self, name: str) -> dict[str, Union[str, 'Balances']]:
+        """
+        Take a snap that is shared with the other `async_snap` calls made within `batch_window_ms`.
+
+        The first call starts a balance fetch that waits `batch_window_ms` before fetching, calls made during that
+        time join it instead of fetching the balances again. Calls made after the fetch has started get a new one,
+        so that a snap never contains balances from before it was requested.
+
+        Parameters
+        -----------
+        name: str
+            The name that will be assigned to the snap
+
+        Returns
+        -------
+        Dict[str, Union[str, Balances]]
+            The snap that was taken. {"name": name, "block": block number, "balances": Balances}
+            Balances are shared by all the snaps of the same fetch.
+        """
+        loop = asyncio.get_running_loop()
+        pending = self._pending_snapshot
+        if pending is None or pending.get_loop() is not loop:
+            pending = asyncio.ensure_future(self._delayed_snapshot())
+            self._pending_snapshot = pending
+
+        # shielded so that one cancelled caller doesn't cancel the fetch for the others
+        snap = await asyncio.shield(pending)
+        return {**snap, "name": name}
+
+    async def _delayed_snapshot(self) -> dict[str, Union[str, 'Balances']]:
+        """Wait `batch_window_ms` for other snaps to join, then take the snap for all of them."""
+        try:
+            await asyncio.sleep(self.batch_window_ms / 1000)
+        finally:
+            # calls made from here on have to wait for a new fetch
+            self._pending_snapshot = None
+
+        return await self._async_take_snapshot("")
+
+    def close(self):
+        """
+        Close the HTTP session and the executor of the snapshotter.
+
+        The loop is also closed if it was created by the snapshotter.
+        The snapshotter can still be used afterwards, the session, the executor threads and the loop are created again
+        when they're needed.
+        Can't be used while a loop is running in the current thread, use `aclose` instead.
+        """
+        self._run(self.aclose(), "aclose")
+
+        if self._owns_loop:
+            self._loop.run_until_complete(self._loop.shutdown_asyncgens())
+            self._loop.close()
+            self._loop = None
+            self._owns_loop = False
+
+    async def aclose(self):
+        """Close the HTTP session and the executor of the snapshotter from async context."""
+        loop = asyncio.get_running_loop()
+        if self._session is not None and self._session_loop is loop:
+            await self._session.close()
+            self._session = None
+        else:
+            self._discard_session()
+
+        stale_sessions = self._stale_sessions
+        self._stale_sessions = []
+        for session, session_loop in stale_sessions:
+            if session_loop is loop:
+                await session.close()
+            else:
+                self._stale_sessions.append((session, session_loop))
+
+        # the threads of the old executor finish in the background, the new one only starts threads when it's used
+        self._executor.shutdown(wait=False)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+
+    def __enter__(self) -> 'BalanceSnapshotter':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    async def __aenter__(self) -> 'BalanceSnapshotter':
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.aclose()
+
+    def _run(self, coroutine: Coroutine, async_name: str) -> Any:
+        """
+        Run a coroutine until it completes from sync context.
+
+        If the loop of the snapshotter is running in another thread, the coroutine is run in that loop and this thread
+        waits for the result.
+
+        Parameters
+        -----------
+        coroutine: Coroutine
+            The coroutine that will be run.
+        async_name: str
+            Name of the method that should be used instead in async context, used in the error message.
+
+        Returns
+        -------
+        Any
+            The result of the coroutine.
+        """
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            pass
+        else:
+            coroutine.close()
+            raise RuntimeError(f"Loop is already running, use {async_name} from async context")
+
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+            self._owns_loop = True
+        elif self._loop.is_running():
+            # the loop is running in another thread, so the coroutine is handed over to it
+            return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+        return self._loop.run_until_complete(coroutine)
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        """
+        Get the HTTP session of the snapshotter, creating it if needed.
+
+        The session is reused across snaps, so that connections to the provider are kept alive between them.
+
+        Returns
+        -------
+        aiohttp.ClientSession
+            The session bound to the running loop.
+        """
+        import aiohttp
+
+        loop = asyncio.get_running_loop()
+        # a session can only be used in the loop it was created in
+        if self._session is not None and self._session_loop is not loop:
+            self._discard_session()
+
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=50, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(connector=connector)
+            self._session_loop = loop
+
+        return self._session
+
+    def _discard_session(self):
+        """
+        Close the HTTP session of the snapshotter without awaiting it from its own loop.
+
+        If the loop of the session is running in another thread, the session is closed in that loop. If the loop is
+        stopped, the session is kept until `aclose` runs in that loop. If the loop is closed, the session can't be
+        closed anymore, so it's dropped with a warning.
+        """
+        session, session_loop = self._session, self._session_loop
+        self._session = None
+        self._session_loop = None
+        if session is None or session.closed:
+            return
+
+        if session_loop is not None and session_loop.is_running():
+            asyncio.run_coroutine_threadsafe(session.close(), session_loop)
+            return
+
+        if session_loop is not None and not session_loop.is_closed():
+            self._stale_sessions.append((session, session_loop))
+            return
+
+        # aiohttp still reports the session as unclosed when it's garbage collected, as its connections were bound to
+        # the closed loop and can't be closed
+        logger.warning("Dropping an HTTP session whose loop has been closed, its connections can't be closed")
+
+    async def _async_take_snapshot(self, name: str) -> dict[str, Union[str, 'Balances']]:
         """
         Function that gathers token balances for accounts in an asynchronous manner.
 
-        The function will gather all the needed balanceOf calls into a list and through asyncio gather they will all
-        be called at the same time, improving efficiency.
+        All balances are fetched at the same block, so that the snap is consistent even if a new block comes in
+        while it's being taken.
+
+        If Multicall3 or Multicall2 is deployed on the active chain, the latest block number is fetched first and all
+        the balances are fetched at that block in multicalls of at most `multicall_batch_size` calls. Otherwise the
+        latest block is fetched first, balances already fetched in that block, identified by its hash, are taken from
+        the balance cache and only the rest are fetched.
 
         Parameters
         -----------
         name: str
             The name that will be assigned to the snap
+
+        Returns
+        -------
+        Dict[str, Union[str, Balances]]
+            The snap that was taken. {"name": name, "block": block number, "balances": Balances}
+        """
+        from brownie import web3
+        from .multicall import aggregate_balances
+
+        loop = asyncio.get_running_loop()
+
+        # token data of newly added tokens is fetched before the balances, this also looks up the multicall contract
+        if not self._multicall_checked or len(self._decimals) < len(self.tokens):
+            await loop.run_in_executor(self._executor, self.prefetch_metadata)
+
+        token_index, account_index = self._get_indices()
+        balances = Balances(self.tokens, self.accounts, self._decimals, self._symbols, token_index, account_index)
+
+        if self.multicall is not None:
+            # the whole snap is one multicall per `multicall_batch_size` balances, so there's little for the balance
+            # cache to save
+            pairs = [(token, account) for token in self.tokens for account in self.accounts]
+            block, values = await loop.run_in_executor(
+                self._executor, aggregate_balances, self.multicall, pairs, self.multicall_batch_size
+            )
+            # pairs are in row major order, so the values can be put into the matrix in one go
+            balances.matrix[:] = np.array(values, dtype=object).reshape(balances.matrix.shape)
+
+            return {"name": name, "block": block, "balances": balances}
+
+        # the number and the hash come from the same block, the number pins the calls and the hash keys the cache
+        latest = await loop.run_in_executor(self._executor, web3.eth.get_block, "latest")
+        block, block_hash = latest["number"], bytes(latest["hash"])
+
+        missing = []
+        missing_indices = []
+        for i, token in enumerate(self.tokens):
+            for j, account in enumerate(self.accounts):
+                key = (block_hash, token.address, account.address)
+                if key in self._balance_cache:
+                    balances.matrix[i, j] = self._balance_cache[key]
+                else:
+                    missing.append((token, account))
+                    missing_indices.append((i, j))
+
+        values = await self._fetch_balances(missing, block) if missing else []
+        for (token, account), (i, j), value in zip(missing, missing_indices, values):
+            balances.matrix[i, j] = value
+
+            self._balance_cache[(block_hash, token.address, account.address)] = value
+            if len(self._balance_cache) > BALANCE_CACHE_SIZE:
+                self._balance_cache.popitem(last=False)
+
+        return {"name": name, "block": block, "balances": balances}
+
+    async def _fetch_balances(self, pairs: list[tuple[Contract, Account]], block: int) -> list[int]:
         """
-        balances = Balances()
+        Fetch the balances of token and account pairs from chain without a multicall contract.
 
-        async def set_balance(_token, _account):
-            value = _token.balanceOf(_account)
-            balances.set(_token, _account, value)
+        The balanceOf calls are sent in JSON-RPC batch requests of `erc20_batch_size` calls. If the provider doesn't
+        support batch requests, they're sent as separate concurrent requests instead. If the provider isn't an HTTP
+        provider, every balanceOf call is made separately in an executor.
 
-        futures = []
-        for token in self.tokens:
-            for account in self.accounts:
-                future = set_balance(token, account)
-                futures.append(future)
+        Parameters
+        -----------
+        pairs: List[Tuple[brownie.network.contract.Contract, brownie.network.account.Account]]
+            The token and account pairs whose balances will be fetched.
+        block: int
+            Number of the block the balances will be fetched at.
+
+        Returns
+        -------
+        List[int]
+            The balances in the same order as `pairs`.
+        """
+        from .rpc import get_endpoint_uri, batch_balances, call_balances, BatchRequestRejected
+        from .workers import run_workers
+
+        endpoint_uri = get_endpoint_uri()
+        if endpoint_uri is not None:
+            if self._batch_requests_supported:
+                try:
+                    return await batch_balances(self._get_session(), endpoint_uri, pairs, block, self.erc20_batch_size)
+                except BatchRequestRejected:
+                    self._batch_requests_supported = False
 
-        await asyncio.gather(*futures)
+            return await call_balances(self._get_session(), endpoint_uri, pairs, block, self.max_concurrency)
 
-        self.snaps.append({"name": name, "balances": balances})
-        self.balance_event.set()
+        # balanceOf calls are blocking, so they're run in the executor by `max_concurrency` workers
+        loop = asyncio.get_running_loop()
+        balances = [0] * len(pairs)
+
+        async def get_balance(item):
+            i, (token, account) = item
+            balances[i] = await loop.run_in_executor(
+                self._executor, partial(token.balanceOf, account, block_identifier=block)
+            )
+
+        await run_workers(enumerate(pairs), min(self.max_concurrency, len(pairs)), get_balance)
+
+        return balances
 
     def diff_last_two(self, print_diff: bool = True) -> str:
         """
@@ -211,31 +825,39 @@ class BalanceSnapshotter:
         before_snap = self.snaps[-2]
         after_snap = self.snaps[-1]
 
+        blocks = f'blocks {before_snap["block"]} to {after_snap["block"]}'
         if before_snap["name"] != "" and after_snap["name"] != "":
-            console.print(f'[green]== Comparing Balances: {before_snap["name"]} and {after_snap["name"]} ==[/green]')
+            console.print(
+                f'[green]== Comparing Balances: {before_snap["name"]} and {after_snap["name"]} ({blocks}) ==[/green]'
+            )
         else:
-            console.print("[green]== Comparing Balances: Latest two snapshots ==[/green]")
-
-        before = before_snap['balances'].balances
-        after = after_snap['balances'].balances
-
-        table = []
-        for token, accounts in before.items():
-            for account, value in accounts.items():
-                amount = decimal_converter(
-                    after[token][account] - value,
-                    decimals=token_data.get_decimals(token),
-                )
+            console.print(f"[green]== Comparing Balances: Latest two snapshots ({blocks}) ==[/green]")
 
-                # ignore 0 balance
-                if amount == 0:
-                    continue
-
-                table.append([token_data.get_symbol(token), account, amount])
+        before = before_snap['balances']
+        after = after_snap['balances']
 
-        table = tabulate(table, headers=["asset", "account", "balance"])
+        if before.token_index is after.token_index and before.account_index is after.account_index:
+            # both snaps were taken with the same tokens and accounts, so the matrices are already lined up
+            delta = after.matrix - before.matrix
+        else:
+            # line up the rows and columns of the last snap with the second to last snap, in case tokens or accounts
+            # were added in between
+            rows = [after.token_index[token.address] for token in before.tokens]
+            columns = [after.account_index[account.address] for account in before.accounts]
+            delta = after.matrix[np.ix_(rows, columns)] - before.matrix
+
+        rows = []
+        # only balances that changed are visited, their deltas are gathered in one go instead of cell by cell
+        changed_rows, changed_columns = np.nonzero(delta)
+        changed = delta[changed_rows, changed_columns]
+        for i, j, value in zip(changed_rows.tolist(), changed_columns.tolist(), changed.tolist()):
+            token = before.tokens[i].address
+            amount = amount_formatter(self._decimals[token])(value)
+            rows.append((self._symbols[token], before.accounts[j].address, amount))
+
+        table = format_table(rows)
         if print_diff:
-            print(table)
+            print_table(rows)
 
         return table
 
@@ -244,14 +866,79 @@ class Balances:
     """
     Class used to store balances for snapshots.
 
+    Balances are stored in a matrix where rows are tokens and columns are accounts.
+
+    Parameters
+    ----------
+    tokens: List[brownie.network.contract.Contract]
+        The tokens whose balances will be stored.
+    accounts: List[brownie.network.account.Account]
+        The accounts whose balances will be stored.
+    decimals: Optional[Dict[str, int]]
+        Decimals of the tokens keyed by token address, tokens that are missing will be looked up from token data.
+    symbols: Optional[Dict[str, str]]
+        Symbols of the tokens keyed by token address, tokens that are missing will be looked up from token data.
+    token_index: Optional[Dict[str, int]]
+        Row index of every token keyed by token address, built from `tokens` if not provided.
+        Snaps taken with the same tokens share it.
+    account_index: Optional[Dict[str, int]]
+        Column index of every account keyed by account address, built from `accounts` if not provided.
+        Snaps taken with the same accounts share it.
+
     Attributes
     -----------
-    balances: Dict[brownie.network.contract.Contract, Dict[brownie.network.account.Account, float]]
-        Dictionary that contains the token balances of all the accounts.
+    tokens: List[brownie.network.contract.Contract]
+        The tokens, in the order of the matrix rows.
+    accounts: List[brownie.network.account.Account]
+        The accounts, in the order of the matrix columns.
+    token_index: Dict[str, int]
+        Row index of every token keyed by token address.
+    account_index: Dict[str, int]
+        Column index of every account keyed by account address.
+    matrix: numpy.ndarray
+        Matrix of the token balances of all the accounts. Python ints are used as values,
+        as token balances don't fit into 64 bits.
+    decimals: Dict[str, int]
+        Decimals of the tokens keyed by token address.
+    symbols: Dict[str, str]
+        Symbols of the tokens keyed by token address.
     """
 
-    def __init__(self):
-        self.balances: dict[Contract, dict[Account, int]] = {}
+    def __init__(
+            self,
+            tokens: list[Contract],
+            accounts: list[Account],
+            decimals: dict[str, int] = None,
+            symbols: dict[str, str] = None,
+            token_index: dict[str, int] = None,
+            account_index: dict[str, int] = None
+    ):
+        self.tokens: list[Contract] = list(tokens)
+        self.accounts: list[Account] = list(accounts)
+        if token_index is None:
+            token_index = {token.address: i for i, token in enumerate(self.tokens)}
+        if account_index is None:
+            account_index = {account.address: i for i, account in enumerate(self.accounts)}
+        self.token_index: dict[str, int] = token_index
+        self.account_index: dict[str, int] = account_index
+        self.matrix: np.ndarray = np.zeros((len(self.tokens), len(self.accounts)), dtype=object)
+        self.decimals: dict[str, int] = decimals if decimals is not None else {}
+        self.symbols: dict[str, str] = symbols if symbols is not None else {}
+
+    @property
+    def balances(self) -> dict[str, dict[str, int]]:
+        """
+        Dictionary that contains the token balances of all the accounts.
+
+        Returns
+        -------
+        Dict[str, Dict[str, int]]
+            The balances in the form {token address: {account address: balance}}
+        """
+        return {
+            token: dict(zip(self.account_index, values))
+            for token, values in zip(self.token_index, self.matrix)
+        }
 
     def set(self, token: Contract, account: Account, value: int):
         """
@@ -266,27 +953,30 @@ class Balances:
         value: int
             The amount of tokens.
         """
-        if token not in self.balances:
-            self.balances[token] = {}
-        self.balances[token][account] = value
+        self.matrix[self.token_index[token.address], self.account_index[account.address]] = value
 
-    def get(self, token: Contract, account: Account) -> int:
+    def get(self, token: Union[Contract, str], account: Union[Account, str]) -> int:
         """
         Get the token balance value for an account.
 
         Parameters
         -----------
-        token: brownie.network.contract.Contract
-            The token.
-        account: brownie.network.account.Account
-            The account.
+        token: Union[brownie.network.contract.Contract, str]
+            The token or its address.
+        account: Union[brownie.network.account.Account, str]
+            The account or its address.
 
         Returns
         -------
         int
             the token balance for an account.
         """
-        return self.balances[token][account]
+        # balances are keyed by checksum address, addresses given in any other case are converted to it
+        from brownie.convert import to_address
+
+        i = self.token_index[to_address(get_address(token))]
+        j = self.account_index[to_address(get_address(account))]
+        return self.matrix[i, j]
 
     def print(self):
         """
@@ -297,21 +987,21 @@ class Balances:
             -------  ------------------------------------------  ---------
             WBTC     0x5b5cF8620292249669e1DCC73B753d01543D6Ac7    4.72318
         """
-        table = []
-        for token, accounts in self.balances.items():
-            for account, value in accounts.items():
-                amount = decimal_converter(value, decimals=token_data.get_decimals(token))
-
-                # ignore 0 balance
-                if amount == 0:
+        rows = []
+        for token, values in zip(self.tokens, self.matrix):
+            if token.address not in self.decimals:
+                data = token_data.fetch_token_data(token)
+                self.decimals[token.address] = data['decimals']
+                self.symbols[token.address] = data['symbol']
+
+            format_amount = amount_formatter(self.decimals[token.address])
+            symbol = self.symbols[token.address]
+
+            for account, value in zip(self.accounts, values):
+                # ignore 0 balance, checked before formatting as the formatted amount is never equal to 0
+                if value == 0:
                     continue
 
-                table.append(
-                    [
-                        token_data.get_symbol(token),
-                        account.address,
-                        decimal_converter(value, decimals=token_data.get_decimals(token))
-                    ]
-                )
+                rows.append((symbol, account.address, format_amount(value)))
 
-        print(tabulate(table, headers=["asset", "account", "balance"]))
+        print_table(rows)
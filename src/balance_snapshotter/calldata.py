@@ -0,0 +1,87 @@
+"""Module for encoding and decoding balanceOf calls without going through the ABI encoder."""
+from typing import Union, Sequence, TypeVar
+
+T = TypeVar("T")
+
+# first 4 bytes of keccak("balanceOf(address)"), same for every ERC20 token
+BALANCE_OF_SELECTOR = bytes.fromhex("70a08231")
+
+
+def balance_of_calldata(address: str) -> bytes:
+    """
+    Build the calldata of a balanceOf call.
+
+    As the only argument is the address, the calldata doesn't depend on the token and can be reused for every token.
+
+    Parameters
+    ----------
+    address: str
+        The address whose balance will be fetched.
+
+    Returns
+    -------
+    bytes
+        The balanceOf selector followed by the address padded to 32 bytes.
+    """
+    return BALANCE_OF_SELECTOR + bytes.fromhex(address[2:]).rjust(32, b"\0")
+
+
+def balance_of_calldata_by_account(pairs: Sequence[tuple[object, object]]) -> dict[str, bytes]:
+    """
+    Build the calldata of the balanceOf calls of token and account pairs.
+
+    The calldata only depends on the account, so it's built once per account instead of once per pair.
+
+    Parameters
+    ----------
+    pairs: Sequence[Tuple[brownie.network.contract.Contract, brownie.network.account.Account]]
+        The token and account pairs whose balances will be fetched.
+
+    Returns
+    -------
+    Dict[str, bytes]
+        The calldata keyed by account address.
+    """
+    return {address: balance_of_calldata(address) for address in {account.address for _, account in pairs}}
+
+
+def chunked(items: Sequence[T], size: int) -> list[Sequence[T]]:
+    """
+    Split items into consecutive chunks.
+
+    Parameters
+    ----------
+    items: Sequence[T]
+        The items, e.g. calls or requests.
+    size: int
+        Maximum amount of items in a chunk.
+
+    Returns
+    -------
+    List[Sequence[T]]
+        The chunks in order, the last one can be shorter than `size`. Empty if there are no items.
+    """
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def decode_balance(data: Union[bytes, str]) -> int:
+    """
+    Decode the data returned by a balanceOf call.
+
+    Parameters
+    ----------
+    data: Union[bytes, str]
+        The returned data as bytes or as a hex string.
+
+    Returns
+    -------
+    int
+        The balance.
+    """
+    if isinstance(data, str):
+        data = bytes.fromhex(data[2:] if data.startswith("0x") else data)
+
+    if len(data) != 32:
+        raise ValueError(f"balanceOf returned {len(data)} bytes instead of 32, the call likely reverted")
+
+    return int.from_bytes(data, "big")
@@ -0,0 +1,235 @@
+"""Module for aggregating balanceOf and token data calls into Multicall3 or Multicall2 calls."""
+from typing import Optional, Union
+from brownie.network.contract import Contract
+from brownie.network.account import Account
+from brownie._config import CONFIG
+from brownie import web3
+from .calldata import balance_of_calldata_by_account, chunked, decode_balance
+
+# default maximum amount of calls in a single multicall, so that a multicall stays well below the eth_call gas cap
+# and response size limits of nodes, e.g. geth's default 50M gas cap
+MULTICALL_BATCH_SIZE = 500
+
+# Multicall3 is deployed to the same address on every chain it exists on
+MULTICALL3_ADDRESS = "0xcA11bde05977b3631167028862bE2a173976CA11"
+MULTICALL3_ABI = [
+    {
+        "inputs": [
+            {
+                "components": [
+                    {"internalType": "address", "name": "target", "type": "address"},
+                    {"internalType": "bool", "name": "allowFailure", "type": "bool"},
+                    {"internalType": "bytes", "name": "callData", "type": "bytes"}
+                ],
+                "internalType": "struct Multicall3.Call3[]",
+                "name": "calls",
+                "type": "tuple[]"
+            }
+        ],
+        "name": "aggregate3",
+        "outputs": [
+            {
+                "components": [
+                    {"internalType": "bool", "name": "success", "type": "bool"},
+                    {"internalType": "bytes", "name": "returnData", "type": "bytes"}
+                ],
+                "internalType": "struct Multicall3.Result[]",
+                "name": "returnData",
+                "type": "tuple[]"
+            }
+        ],
+        "stateMutability": "payable",
+        "type": "function"
+    }
+]
+
+MULTICALL2_ABI = [
+    {
+        "inputs": [
+            {"internalType": "bool", "name": "requireSuccess", "type": "bool"},
+            {
+                "components": [
+                    {"internalType": "address", "name": "target", "type": "address"},
+                    {"internalType": "bytes", "name": "callData", "type": "bytes"}
+                ],
+                "internalType": "struct Multicall2.Call[]",
+                "name": "calls",
+                "type": "tuple[]"
+            }
+        ],
+        "name": "tryBlockAndAggregate",
+        "outputs": [
+            {"internalType": "uint256", "name": "blockNumber", "type": "uint256"},
+            {"internalType": "bytes32", "name": "blockHash", "type": "bytes32"},
+            {
+                "components": [
+                    {"internalType": "bool", "name": "success", "type": "bool"},
+                    {"internalType": "bytes", "name": "returnData", "type": "bytes"}
+                ],
+                "internalType": "struct Multicall2.Result[]",
+                "name": "returnData",
+                "type": "tuple[]"
+            }
+        ],
+        "stateMutability": "nonpayable",
+        "type": "function"
+    }
+]
+
+
+def get_multicall() -> Optional[Contract]:
+    """
+    Get the multicall contract of the active chain.
+
+    Multicall3 is preferred, if it isn't deployed, the Multicall2 set as `multicall2` in brownie's network config for
+    the active network is used.
+
+    Returns
+    -------
+    Optional[brownie.network.contract.Contract]
+        The Multicall3 or Multicall2 contract or None if neither is deployed on the active chain.
+    """
+    # the contracts aren't persisted, so that they aren't written into brownie's deployments database and don't
+    # overwrite entries the user already has for these addresses with the trimmed abis
+    if web3.eth.get_code(MULTICALL3_ADDRESS):
+        return Contract.from_abi("Multicall3", MULTICALL3_ADDRESS, MULTICALL3_ABI, persist=False)
+
+    # brownie's own multicall would deploy Multicall2 on development networks, which would change the state
+    # of the chain that is being snapshotted, so only an already deployed one is used
+    multicall2_address = CONFIG.active_network.get("multicall2")
+    if multicall2_address and web3.eth.get_code(multicall2_address):
+        return Contract.from_abi("Multicall2", multicall2_address, MULTICALL2_ABI, persist=False)
+
+    return None
+
+
+def aggregate(
+        multicall: Contract,
+        calls: list[tuple[str, Union[bytes, str]]],
+        batch_size: int = MULTICALL_BATCH_SIZE
+) -> tuple[int, list[tuple[bool, bytes]]]:
+    """
+    Make calls in multicalls of at most `batch_size` calls, all made at the latest block.
+
+    Multicall3 calls are made through aggregate3 and Multicall2 calls through tryBlockAndAggregate.
+    Calls are allowed to fail. The number of the latest block is fetched from the node first and every multicall is
+    made at that block, so that all the calls see the same state. The block number returned by the multicall contract
+    isn't used, as on some chains, e.g. Arbitrum, `block.number` isn't the block number of the chain itself.
+
+    Parameters
+    ----------
+    multicall: brownie.network.contract.Contract
+        The Multicall3 or Multicall2 contract.
+    calls: List[Tuple[str, Union[bytes, str]]]
+        The calls in the form (target address, calldata).
+    batch_size: int
+        Maximum amount of calls in a single multicall.
+
+    Returns
+    -------
+    Tuple[int, List[Tuple[bool, bytes]]]
+        Number of the block the calls were made at and the results in the form (success, return data) in the same
+        order as `calls`.
+    """
+    block = web3.eth.block_number
+
+    # the multicall functions aren't view functions, so they have to be explicitly called instead of transacted
+    results = []
+    for chunk in chunked(calls, batch_size):
+        if multicall.address == MULTICALL3_ADDRESS:
+            calls3 = [(target, True, calldata) for target, calldata in chunk]
+            results.extend(multicall.aggregate3.call(calls3, block_identifier=block))
+        else:
+            _, _, chunk_results = multicall.tryBlockAndAggregate.call(False, chunk, block_identifier=block)
+            results.extend(chunk_results)
+
+    return block, results
+
+
+def aggregate_balances(
+        multicall: Contract,
+        pairs: list[tuple[Contract, Account]],
+        batch_size: int = MULTICALL_BATCH_SIZE
+) -> tuple[int, list[int]]:
+    """
+    Fetch the block number and the balances of all the token and account pairs in multicalls made at the same block.
+
+    Parameters
+    ----------
+    multicall: brownie.network.contract.Contract
+        The Multicall3 or Multicall2 contract.
+    pairs: List[Tuple[brownie.network.contract.Contract, brownie.network.account.Account]]
+        The token and account pairs whose balances will be fetched.
+    batch_size: int
+        Maximum amount of balanceOf calls in a single multicall.
+
+    Returns
+    -------
+    Tuple[int, List[int]]
+        Number of the block the balances were fetched at and the balances in the same order as `pairs`.
+    """
+    calldata = balance_of_calldata_by_account(pairs)
+    calls = [(token.address, calldata[account.address]) for token, account in pairs]
+    block, results = aggregate(multicall, calls, batch_size)
+
+    balances = []
+    for (token, account), (success, return_data) in zip(pairs, results):
+        # repeat failed calls on their own so that the actual revert reason gets raised
+        if not success or len(return_data) != 32:
+            balances.append(token.balanceOf(account, block_identifier=block))
+            continue
+
+        balances.append(decode_balance(return_data))
+
+    return block, balances
+
+
+def aggregate_token_data(
+        multicall: Contract,
+        tokens: list[Contract],
+        batch_size: int = MULTICALL_BATCH_SIZE
+) -> list[Optional[dict[str, Union[str, int]]]]:
+    """
+    Fetch the name, symbol and decimals of all the tokens in multicalls made at the same block.
+
+    Parameters
+    ----------
+    multicall: brownie.network.contract.Contract
+        The Multicall3 or Multicall2 contract.
+    tokens: List[brownie.network.contract.Contract]
+        The tokens whose data will be fetched.
+    batch_size: int
+        Maximum amount of calls in a single multicall, every token takes 3 calls.
+
+    Returns
+    -------
+    List[Optional[Dict[str, Union[str, int]]]]
+        Token data in dict form {"name": name, "symbol": symbol, "decimals": decimals} in the same order as `tokens`.
+        None for tokens whose data couldn't be fetched or decoded.
+    """
+    calls = []
+    for token in tokens:
+        calls.append((token.address, token.name.encode_input()))
+        calls.append((token.address, token.symbol.encode_input()))
+        calls.append((token.address, token.decimals.encode_input()))
+
+    _, results = aggregate(multicall, calls, batch_size)
+
+    data = []
+    for i, token in enumerate(tokens):
+        (name_success, name), (symbol_success, symbol), (decimals_success, decimals) = results[i * 3:i * 3 + 3]
+        if not (name_success and symbol_success and decimals_success):
+            data.append(None)
+            continue
+
+        # tokens that don't follow the standard, e.g. ones with a bytes32 name, fail to decode
+        try:
+            data.append({
+                'name': token.name.decode_output(name),
+                'symbol': token.symbol.decode_output(symbol),
+                'decimals': token.decimals.decode_output(decimals)
+            })
+        except Exception:
+            data.append(None)
+
+    return data
@@ -0,0 +1,207 @@
+"""Module for batching balanceOf calls into JSON-RPC batch requests."""
+import asyncio
+import aiohttp
+from typing import Optional
+from brownie.network.contract import Contract
+from brownie.network.account import Account
+from brownie import web3
+from .calldata import balance_of_calldata_by_account, chunked, decode_balance
+from .workers import run_workers
+
+
+def get_endpoint_uri() -> Optional[str]:
+    """
+    Get the HTTP endpoint of the active web3 provider.
+
+    Returns
+    -------
+    Optional[str]
+        The endpoint uri or None if the provider doesn't communicate over HTTP.
+    """
+    endpoint_uri = getattr(web3.provider, "endpoint_uri", None)
+    if endpoint_uri is None or not str(endpoint_uri).startswith("http"):
+        return None
+
+    return str(endpoint_uri)
+
+
+class BatchRequestRejected(ValueError):
+    """Raised when the provider doesn't support JSON-RPC batch requests."""
+
+
+# JSON-RPC error codes that providers without batch support reply with, "invalid request" and "method not found"
+BATCH_REJECTION_CODES = {-32600, -32601}
+
+
+def is_batch_rejection(response: dict) -> bool:
+    """
+    Check whether a single object reply to a batch request means that the provider doesn't support batch requests.
+
+    Other errors, e.g. rate limit errors, are only temporary and don't mean that batching should be given up on.
+
+    Parameters
+    ----------
+    response: dict
+        The JSON-RPC reply to the batch request.
+
+    Returns
+    -------
+    bool
+        True if the reply rejects batching.
+    """
+    error = response.get("error")
+    if not isinstance(error, dict):
+        return False
+
+    return error.get("code") in BATCH_REJECTION_CODES or "batch" in str(error.get("message", "")).lower()
+
+
+def build_requests(pairs: list[tuple[Contract, Account]], block: int) -> list[dict]:
+    """
+    Build balanceOf eth_call JSON-RPC requests for token and account pairs.
+
+    Parameters
+    ----------
+    pairs: List[Tuple[brownie.network.contract.Contract, brownie.network.account.Account]]
+        The token and account pairs whose balances will be fetched.
+    block: int
+        Number of the block the balances will be fetched at.
+
+    Returns
+    -------
+    List[dict]
+        The requests, the id of a request is the index of its pair in `pairs`.
+    """
+    calldata = {address: "0x" + data.hex() for address, data in balance_of_calldata_by_account(pairs).items()}
+
+    return [
+        {
+            "jsonrpc": "2.0",
+            "id": i,
+            "method": "eth_call",
+            "params": [{"to": token.address, "data": calldata[account.address]}, hex(block)]
+        }
+        for i, (token, account) in enumerate(pairs)
+    ]
+
+
+def decode_result(result: dict) -> int:
+    """
+    Decode the balance from the response to a balanceOf eth_call request.
+
+    Parameters
+    ----------
+    result: dict
+        The JSON-RPC response.
+
+    Returns
+    -------
+    int
+        The balance.
+    """
+    if "error" in result:
+        raise ValueError(f"eth_call failed: {result['error']}")
+
+    return decode_balance(result["result"])
+
+
+async def batch_balances(
+        session: aiohttp.ClientSession,
+        endpoint_uri: str,
+        pairs: list[tuple[Contract, Account]],
+        block: int,
+        batch_size: int = 100
+) -> list[int]:
+    """
+    Fetch the balances of all the token and account pairs through JSON-RPC batch requests.
+
+    Each batch request contains at most `batch_size` eth_call requests, all batch requests are sent concurrently.
+
+    Parameters
+    ----------
+    session: aiohttp.ClientSession
+        Session the batch requests will be sent with.
+    endpoint_uri: str
+        HTTP endpoint the batch requests will be sent to.
+    pairs: List[Tuple[brownie.network.contract.Contract, brownie.network.account.Account]]
+        The token and account pairs whose balances will be fetched.
+    block: int
+        Number of the block the balances will be fetched at.
+    batch_size: int
+        Maximum amount of eth_call requests in a single batch request.
+
+    Returns
+    -------
+    List[int]
+        The balances in the same order as `pairs`.
+    """
+    requests = build_requests(pairs, block)
+
+    async def post_batch(batch):
+        async with session.post(endpoint_uri, json=batch) as response:
+            response.raise_for_status()
+            return await response.json(content_type=None)
+
+    responses = await asyncio.gather(*[post_batch(batch) for batch in chunked(requests, batch_size)])
+
+    balances = [0] * len(pairs)
+    received = set()
+    for response in responses:
+        # providers that don't support batching respond with a single error object
+        if not isinstance(response, list):
+            if isinstance(response, dict) and is_batch_rejection(response):
+                raise BatchRequestRejected(f"Batch request was rejected: {response}")
+            raise ValueError(f"Batch request failed: {response}")
+
+        # responses in a batch can come back in any order, so they're matched back to the pairs by id
+        for result in response:
+            balances[result["id"]] = decode_result(result)
+            received.add(result["id"])
+
+    # a balance without a response would otherwise be reported as 0
+    if len(received) != len(pairs):
+        raise ValueError(f"Batch responses are missing {len(pairs) - len(received)} of {len(pairs)} balances")
+
+    return balances
+
+
+async def call_balances(
+        session: aiohttp.ClientSession,
+        endpoint_uri: str,
+        pairs: list[tuple[Contract, Account]],
+        block: int,
+        max_concurrency: int = 20
+) -> list[int]:
+    """
+    Fetch the balances of all the token and account pairs through separate concurrent eth_call requests.
+
+    Used for providers that don't support JSON-RPC batch requests.
+
+    Parameters
+    ----------
+    session: aiohttp.ClientSession
+        Session the requests will be sent with.
+    endpoint_uri: str
+        HTTP endpoint the requests will be sent to.
+    pairs: List[Tuple[brownie.network.contract.Contract, brownie.network.account.Account]]
+        The token and account pairs whose balances will be fetched.
+    block: int
+        Number of the block the balances will be fetched at.
+    max_concurrency: int
+        Maximum amount of requests in flight at once.
+
+    Returns
+    -------
+    List[int]
+        The balances in the same order as `pairs`.
+    """
+    balances = [0] * len(pairs)
+
+    async def post(request):
+        async with session.post(endpoint_uri, json=request) as response:
+            response.raise_for_status()
+            balances[request["id"]] = decode_result(await response.json(content_type=None))
+
+    await run_workers(build_requests(pairs, block), min(max_concurrency, len(pairs)), post)
+
+    return balances
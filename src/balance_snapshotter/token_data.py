@@ -1,23 +1,65 @@
 """Module for caching certain data of tokens to improve efficiency."""
-from typing import Union
-from brownie.network.contract import Contract
-from brownie import interface
+from __future__ import annotations
 
-token_data = None
+import os
+import sqlite3
+import threading
+from pathlib import Path
+from typing import TYPE_CHECKING, Union, Optional
+
+# brownie is only imported when it's first needed, so that importing the package doesn't import it
+if TYPE_CHECKING:
+    from brownie.network.contract import Contract
+
+# token data is immutable, so it's also cached on disk to be reused by later runs
+CACHE_PATH = Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache") / "balance_snapshotter" / "tokens.db"
+
+
+def _get_address(token: Union[Contract, str]) -> str:
+    """
+    Get the checksum address of a token.
+
+    Token data is keyed by checksum address, so addresses given in any other case are converted to it.
+
+    Parameters
+    ----------
+    token: Union[brownie.network.contract.Contract, str])
+        The token as a contract object or token address.
+
+    Returns
+    -------
+    str
+        The checksum address of the token.
+    """
+    if isinstance(token, str):
+        from brownie.convert import to_address
+        return to_address(token)
+
+    return token.address
 
 
 class TokenData:
     """
     Class that manages all the token data.
 
+    Token data of live networks is also cached on disk in `CACHE_PATH`, keyed by chain id and token address.
+    Token data of development networks isn't, as addresses of contracts deployed to them are reused between runs.
+
     Attributes
     ----------
     data: Dict[str, Dict[str, Union[str, int]]]
         Dict that contains all the needed data for tokens.
+    persistent: bool
+        If False, token data isn't read from or written to the disk cache.
     """
 
     def __init__(self):
         self.data: dict[str, dict[str, Union[str, int]]] = {}
+        self.persistent: bool = True
+        # token data can be fetched from several threads at once, e.g. by the executor of a snapshotter
+        self._lock: threading.Lock = threading.Lock()
+        # the disk cache is only opened when it's first needed
+        self._connection: Optional[sqlite3.Connection] = None
 
     def get_decimals(self, token: Union[Contract, str]) -> int:
         """
@@ -82,30 +124,163 @@ class TokenData:
             All the token data in dict form {"name": name, "symbol": symbol, "decimals": decimals}
         """
         # first check if token data is already cached, if not, cache it
-        address = token.address if isinstance(token, Contract) else token
-        if address not in self.data:
-            # only convert token to Contract object if actually needed
-            if isinstance(token, str):
-                token = interface.IERC20(token)
+        address = _get_address(token)
+        if address in self.data:
+            return self.data[address]
 
-            self.data[token.address] = {
-                'name': token.name(),
-                'symbol': token.symbol(),
-                'decimals': token.decimals()
-            }
+        data = self._load(address)
+        if data is not None:
+            return data
 
-        return self.data[token.address]
+        # only convert token to Contract object if actually needed
+        if isinstance(token, str):
+            from brownie import interface
+            token = interface.IERC20(token)
 
+        # the calls are made outside the lock, so that fetching one token doesn't block lookups of others. If another
+        # thread cached the token in the meantime, its data is kept
+        data = {
+            'name': token.name(),
+            'symbol': token.symbol(),
+            'decimals': token.decimals()
+        }
+        self._store(address, data)
+        with self._lock:
+            return self.data.setdefault(address, data)
 
-def get_token_data() -> TokenData:
-    """
-    Get an active TokenData instance.
+    def set_token_data(self, token: Union[Contract, str], data: dict[str, Union[str, int]]):
+        """
+        Cache token data that has been fetched elsewhere.
 
-    Creates one if instance has not yet been established.
-    """
-    global token_data
+        Parameters
+        ----------
+        token: Union[brownie.network.contract.Contract, str])
+            The token as a contract object or token address.
+        data: Dict[str, Union[str, int]]
+            All the token data in dict form {"name": name, "symbol": symbol, "decimals": decimals}
+        """
+        address = _get_address(token)
+        self._store(address, data)
+        with self._lock:
+            self.data[address] = data
+
+    def is_cached(self, token: Union[Contract, str]) -> bool:
+        """
+        Check whether the token data is already cached.
+
+        Parameters
+        ----------
+        token: Union[brownie.network.contract.Contract, str])
+            The token as a contract object or token address.
+
+        Returns
+        -------
+        bool
+            True if the token data is cached.
+        """
+        address = _get_address(token)
+        return address in self.data or self._load(address) is not None
+
+    def _get_connection(self) -> Optional[sqlite3.Connection]:
+        """
+        Get the connection to the disk cache, opening it if needed.
+
+        Has to be called with the lock held.
+
+        Returns
+        -------
+        Optional[sqlite3.Connection]
+            The connection or None if the disk cache isn't used for the active network or it couldn't be opened.
+        """
+        from brownie._config import CONFIG
+
+        if not self.persistent or CONFIG.network_type != "live":
+            return None
+
+        if self._connection is None:
+            try:
+                CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+                # the connection is shared by all threads, access to it is serialized by the lock
+                connection = sqlite3.connect(str(CACHE_PATH), check_same_thread=False)
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS tokens ("
+                    "chain_id INTEGER, address TEXT, name TEXT, symbol TEXT, decimals INTEGER, "
+                    "PRIMARY KEY (chain_id, address))"
+                )
+                self._connection = connection
+            except (OSError, sqlite3.Error):
+                # the disk cache is only an optimization, so it's disabled instead of failing the lookup
+                self.persistent = False
+                return None
+
+        return self._connection
+
+    def _load(self, address: str) -> Optional[dict[str, Union[str, int]]]:
+        """
+        Load token data from the disk cache into the in-memory cache.
+
+        Parameters
+        ----------
+        address: str
+            The checksum address of the token.
+
+        Returns
+        -------
+        Optional[Dict[str, Union[str, int]]]
+            All the token data in dict form {"name": name, "symbol": symbol, "decimals": decimals} or None if the
+            token isn't in the disk cache.
+        """
+        from brownie import chain
+
+        with self._lock:
+            connection = self._get_connection()
+            if connection is None:
+                return None
+
+            try:
+                row = connection.execute(
+                    "SELECT name, symbol, decimals FROM tokens WHERE chain_id = ? AND address = ?", (chain.id, address)
+                ).fetchone()
+            except sqlite3.Error:
+                return None
 
-    if token_data is None:
-        token_data = TokenData()
+            if row is None:
+                return None
 
+            return self.data.setdefault(address, {'name': row[0], 'symbol': row[1], 'decimals': row[2]})
+
+    def _store(self, address: str, data: dict[str, Union[str, int]]):
+        """
+        Store token data in the disk cache.
+
+        Parameters
+        ----------
+        address: str
+            The checksum address of the token.
+        data: Dict[str, Union[str, int]]
+            All the token data in dict form {"name": name, "symbol": symbol, "decimals": decimals}
+        """
+        from brownie import chain
+
+        with self._lock:
+            connection = self._get_connection()
+            if connection is None:
+                return
+
+            try:
+                with connection:
+                    connection.execute(
+                        "INSERT OR IGNORE INTO tokens VALUES (?, ?, ?, ?, ?)",
+                        (chain.id, address, data['name'], data['symbol'], data['decimals'])
+                    )
+            except sqlite3.Error:
+                pass
+
+
+# created at import, so that threads calling get_token_data can't race to create separate instances
+token_data = TokenData()
+
+
+def get_token_data() -> TokenData:
+    """Get the active TokenData instance."""
     return token_data
@@ -0,0 +1,37 @@
+"""Module for running many small async jobs with a fixed amount of worker coroutines."""
+import asyncio
+from typing import Awaitable, Callable, Iterable, TypeVar
+
+T = TypeVar("T")
+
+
+async def run_workers(items: Iterable[T], count: int, handle: Callable[[T], Awaitable[None]]):
+    """
+    Handle all the items with at most `count` items being handled at once.
+
+    The workers share one iterator over the items, so only `count` coroutines are created no matter how many items
+    there are. If handling an item fails, the other workers are cancelled and the exception is raised.
+
+    Parameters
+    ----------
+    items: Iterable[T]
+        The items that will be handled.
+    count: int
+        Amount of workers.
+    handle: Callable[[T], Awaitable[None]]
+        Async function that handles a single item.
+    """
+    remaining = iter(items)
+
+    async def worker():
+        for item in remaining:
+            await handle(item)
+
+    tasks = [asyncio.ensure_future(worker()) for _ in range(count)]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        # don't leave the rest of the items being handled if one of them fails
+        for task in tasks:
+            task.cancel()
+        raise